@@ -1,9 +1,95 @@
 import os
-import json
+import orjson
+import time
+import math
+import random
+import hashlib
+import asyncio
 import httpx
-from typing import Dict, List, Any, Optional
+from array import array
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Any, Optional
 from datetime import datetime
 from app.models import get_db
+from app.batcher import LLMBatcher
+
+DECISION_SYSTEM_MESSAGE = "Ты — AI-агент персонализации"
+DECISION_FIELDS = ["user_profile", "event", "recent_activity"]
+QUALITY_SYSTEM_MESSAGE = "Ты — строгий редактор"
+QUALITY_FIELDS = ["message", "user_context"]
+TEXT_SYSTEM_MESSAGE = "Ты — профессиональный копирайтер"
+
+BATCH_DECISION_INSTRUCTIONS = """**Пакетный режим:**
+Ниже JSON-массив из {count} независимых контекстов (поля user_profile, event, recent_activity).
+Прими решение для каждого из них по правилам выше и ответь строго JSON:
+{{"decisions": [ответ для контекста 1, ответ для контекста 2, ...]}}
+Массив decisions должен содержать ровно {count} элементов в том же порядке.
+
+Контексты:
+{contexts}"""
+
+
+class LLMError(Exception):
+    """LLM API не ответил успешно (после всех повторов)"""
+
+
+def _unavailable_decision() -> Dict:
+    """Решение при недоступном LLM API: сообщение не отправляем"""
+    return {
+        "should_engage": False,
+        "reasoning": "LLM API недоступен",
+        "action": {"type": None}
+    }
+
+
+def _dumps_stable(data: Any) -> str:
+    """JSON с фиксированным порядком ключей — одинаковые данные дают одинаковые байты"""
+    return orjson.dumps(data, option=orjson.OPT_SORT_KEYS).decode()
+
+
+def _dumps(data: Any) -> str:
+    return orjson.dumps(data).decode()
+
+
+def _best_match(entries: List[tuple], vector: array, threshold: float) -> Optional[Dict]:
+    """Ответ с максимальным косинусным сходством, если оно не ниже порога"""
+    best_score, best_value = 0.0, None
+    for _, cached_vector, value in entries:
+        score = sum(a * b for a, b in zip(vector, cached_vector))
+        if score > best_score:
+            best_score, best_value = score, value
+    if best_score >= threshold:
+        return best_value
+    return None
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After в секундах (HTTP-дата не поддерживается)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def _parse_llm_json(content: str) -> Any:
+    """Распарсить JSON из ответа модели
+    
+    Если строгий разбор не удался, пробуем вырезать объект из обёртки
+    (```json ... ``` или пояснения вокруг). Возвращает None, если JSON нет.
+    """
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        pass
+    start, end = content.find("{"), content.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    try:
+        return orjson.loads(content[start:end + 1])
+    except orjson.JSONDecodeError:
+        return None
 
 class PersonalizationAgent:
     """AI-агент для персонализации коммуникаций"""
@@ -13,18 +99,171 @@ class PersonalizationAgent:
         self.model = os.getenv("OPENROUTER_MODEL", "anthropic/claude-3.5-sonnet")
         self.api_base = os.getenv("OPENROUTER_API_BASE", "https://openrouter.ai/api/v1")
         self.temperature = float(os.getenv("AGENT_TEMPERATURE", "0.7"))
+        # Общий асинхронный клиент, чтобы не блокировать event loop FastAPI.
+        # Keep-alive пул и HTTP/2 позволяют не делать TLS-рукопожатие на каждый запрос
+        self._client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=32,
+                keepalive_expiry=60
+            )
+        )
+        # Кэш ответов LLM по точному совпадению запроса: ключ -> (время записи, ответ)
+        self._cache: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self.cache_maxsize = int(os.getenv("LLM_CACHE_MAXSIZE", "10000"))
+        self.cache_ttl = float(os.getenv("LLM_CACHE_TTL", "3600"))
+        # Семантический кэш: близкие по смыслу запросы получают сохранённый ответ
+        self.semantic_cache_enabled = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+        self.embedding_model = os.getenv("OPENROUTER_EMBEDDING_MODEL", "openai/text-embedding-3-small")
+        self.semantic_cache_threshold = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+        # Кэш ведётся отдельно для каждого пользователя: ответы содержат
+        # персональные тексты и не должны попадать к другим клиентам
+        self.semantic_cache_maxsize = int(os.getenv("SEMANTIC_CACHE_MAXSIZE", "20"))
+        self.semantic_cache_max_users = int(os.getenv("SEMANTIC_CACHE_MAX_USERS", "500"))
+        self._semantic_cache: "OrderedDict[bytes, List[tuple]]" = OrderedDict()
+        # Шаблоны промптов меняются редко — держим их в памяти
+        self._prompt_cache: Dict[str, str] = {}
+        # Счётчики использования LLM
+        self.stats: Dict[str, int] = {
+            "prompt_tokens": 0,
+            "cached_prompt_tokens": 0,
+            "llm_retries": 0,
+            "llm_failures": 0,
+            "llm_rate_limited": 0
+        }
+        # Повторы при временных ошибках API (429, 5xx, таймауты)
+        self.max_attempts = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+        self.retry_initial_delay = float(os.getenv("LLM_RETRY_INITIAL_DELAY", "1"))
+        self.retry_max_delay = float(os.getenv("LLM_RETRY_MAX_DELAY", "16"))
+        # Пакетная обработка решений для одновременно пришедших событий
+        self.batch_enabled = os.getenv("DECISION_BATCH_ENABLED", "false").lower() == "true"
+        self._decision_batcher = LLMBatcher(
+            self._decide_batch,
+            max_batch_size=int(os.getenv("DECISION_BATCH_SIZE", "16")),
+            max_wait=float(os.getenv("DECISION_BATCH_WAIT_MS", "15")) / 1000,
+            max_concurrency=int(os.getenv("DECISION_BATCH_CONCURRENCY", "10"))
+        )
+    
+    async def aclose(self):
+        """Закрыть HTTP-клиент (вызывается при остановке приложения)"""
+        await self._decision_batcher.aclose()
+        await self._client.aclose()
+    
+    def cache_clear(self):
+        """Очистить кэш ответов LLM"""
+        self._cache.clear()
+        self._semantic_cache.clear()
+    
+    def _static_prompt(self, name: str, system_message: str, fields: List[str]) -> str:
+        """Неизменяемая часть запроса: роль + шаблон без пользовательских данных
+        
+        Плейсхолдеры шаблона заменяются ссылками на поля JSON из сообщения
+        пользователя, поэтому префикс побайтно совпадает между вызовами и
+        попадает в prompt caching провайдера.
+        """
+        template = self.get_prompt_template(name)
+        if not template:
+            return ""
+        template = template.format(**{f: f"<см. поле {f} во входных данных>" for f in fields})
+        return f"{system_message}\n\n{template}"
+    
+    def _cache_key(self, prompt: str, system_message: str) -> bytes:
+        raw = "\x00".join((self.model, system_message, prompt, str(self.temperature)))
+        return hashlib.blake2b(raw.encode(), digest_size=16).digest()
+    
+    def _cache_get(self, key: bytes) -> Optional[Dict]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if time.monotonic() - stored_at > self.cache_ttl:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return value
+    
+    def _cache_set(self, key: bytes, value: Dict):
+        self._cache[key] = (time.monotonic(), value)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_maxsize:
+            self._cache.popitem(last=False)
+    
+    def _semantic_scope(self, system_message: str, user_key: str) -> bytes:
+        raw = "\x00".join((self.model, system_message, str(self.temperature), user_key))
+        return hashlib.blake2b(raw.encode(), digest_size=16).digest()
+    
+    async def _embed(self, text: str) -> Optional[array]:
+        """Получить нормализованный эмбеддинг текста (None при ошибке)"""
+        try:
+            response = await self._client.post(
+                f"{self.api_base}/embeddings",
+                headers=self._headers(),
+                content=orjson.dumps({"model": self.embedding_model, "input": text})
+            )
+            if response.status_code != 200:
+                print(f"[ERROR] Embedding API error: {response.status_code} - {response.text}")
+                return None
+            vector = orjson.loads(response.content)["data"][0]["embedding"]
+        except Exception as e:
+            print(f"[ERROR] Embedding call failed: {e}")
+            return None
+        
+        norm = math.sqrt(sum(x * x for x in vector))
+        if not norm:
+            return None
+        return array("f", (x / norm for x in vector))
+    
+    async def _semantic_get(self, scope: bytes, vector: array) -> Optional[Dict]:
+        entries = self._semantic_cache.get(scope)
+        if not entries:
+            return None
+        self._semantic_cache.move_to_end(scope)
+        now = time.monotonic()
+        # Выбрасываем устаревшие записи
+        entries[:] = [e for e in entries if now - e[0] <= self.cache_ttl]
+        # Перебор векторов — CPU-работа, уводим её с event loop (на копии списка)
+        return await asyncio.to_thread(
+            _best_match, list(entries), vector, self.semantic_cache_threshold
+        )
+    
+    def _semantic_set(self, scope: bytes, vector: array, value: Dict):
+        entries = self._semantic_cache.setdefault(scope, [])
+        self._semantic_cache.move_to_end(scope)
+        entries.append((time.monotonic(), vector, value))
+        if len(entries) > self.semantic_cache_maxsize:
+            del entries[:len(entries) - self.semantic_cache_maxsize]
+        while len(self._semantic_cache) > self.semantic_cache_max_users:
+            self._semantic_cache.popitem(last=False)
+    
+    def _headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://github.com/aryazansev/AI-agent",
+            "X-Title": "AI Agent Personalization"
+        }
     
     def get_prompt_template(self, name: str) -> str:
         """Получить шаблон промпта из базы данных"""
+        template = self._prompt_cache.get(name)
+        if template is not None:
+            return template
+        
         with get_db() as db:
             cursor = db.execute(
                 "SELECT template FROM prompts WHERE name = ? AND is_active = 1",
                 (name,)
             )
             row = cursor.fetchone()
-            if row:
-                return row["template"]
-        return self._get_default_prompt(name)
+        template = row["template"] if row else self._get_default_prompt(name)
+        self._prompt_cache[name] = template
+        return template
+    
+    def invalidate_prompts(self):
+        """Сбросить закэшированные шаблоны (после изменения промптов в админке)"""
+        self._prompt_cache.clear()
     
     def _get_default_prompt(self, name: str) -> str:
         """Дефолтные промпты на случай если в БД пусто"""
@@ -37,15 +276,15 @@ class PersonalizationAgent:
 - История за 24ч: {recent_activity}
 
 Реши, нужно ли отправить сообщение. Ответь JSON:
-{
+{{
   "should_engage": true/false,
   "reasoning": "почему",
-  "action": {
+  "action": {{
     "type": "email" или "push" или null,
     "subject": "тема",
     "body": "текст"
-  }
-}""",
+  }}
+}}""",
             
             "text_generator": """Напиши персонализированное сообщение для {channel}.
 
@@ -57,39 +296,87 @@ Email: до 150 слов. Push: до 80 символов."""
         }
         return prompts.get(name, "")
     
-    def make_decision(self, user_profile: Dict, event: Dict, recent_activity: List[Dict]) -> Dict:
+    async def make_decision(self, user_profile: Dict, event: Dict, recent_activity: List[Dict]) -> Dict:
         """Принять решение о необходимости коммуникации"""
-        prompt_template = self.get_prompt_template("decision_agent")
+        context = {
+            "user_profile": user_profile,
+            "event": event,
+            "recent_activity": recent_activity
+        }
+        if self.batch_enabled and self.api_key:
+            return await self._decision_batcher.submit(context)
+        return await self._decide_single(context)
+    
+    async def _decide_single(self, context: Dict) -> Dict:
+        system = self._static_prompt("decision_agent", DECISION_SYSTEM_MESSAGE, DECISION_FIELDS)
+        try:
+            return await self._call_llm(_dumps_stable(context), system, kind="decision",
+                                        semantic_key=context["user_profile"].get("user_id"),
+                                        cache_prefix=True, raise_on_error=True)
+        except LLMError:
+            return _unavailable_decision()
+    
+    async def _decide_batch(self, contexts: List[Dict]) -> List[Any]:
+        """Принять решения для пакета контекстов одним вызовом LLM"""
+        if len(contexts) == 1:
+            return [await self._decide_single(contexts[0])]
         
-        prompt = prompt_template.format(
-            user_profile=json.dumps(user_profile, ensure_ascii=False),
-            event=json.dumps(event, ensure_ascii=False),
-            recent_activity=json.dumps(recent_activity, ensure_ascii=False)
+        # Общая часть шаблона отправляется один раз на весь пакет
+        system = self._static_prompt("decision_agent", DECISION_SYSTEM_MESSAGE, DECISION_FIELDS)
+        prompt = BATCH_DECISION_INSTRUCTIONS.format(
+            count=len(contexts),
+            contexts=_dumps_stable(contexts)
         )
         
-        return self._call_llm(prompt, "Ты — AI-агент персонализации")
+        try:
+            result = await self._call_llm(prompt, system, kind="decision",
+                                          cache_prefix=True, raise_on_error=True)
+        except LLMError as e:
+            # API недоступен — запросы по одному только добавят нагрузки.
+            # Сообщения в этом случае не отправляем
+            print(f"[ERROR] Batch decision failed for {len(contexts)} events: {e}")
+            return [_unavailable_decision() for _ in contexts]
+        
+        decisions = result.get("decisions") if isinstance(result, dict) else None
+        if isinstance(decisions, list) and len(decisions) == len(contexts) \
+                and all(isinstance(d, dict) for d in decisions):
+            return decisions
+        
+        # Модель не соблюла формат — решаем по одному
+        print(f"[WARNING] Batch decision malformed, falling back to {len(contexts)} single calls")
+        return await asyncio.gather(
+            *(self._decide_single(context) for context in contexts),
+            return_exceptions=True
+        )
     
-    def generate_text(self, user_profile: Dict, channel: str, context: Dict) -> str:
-        """Сгенерировать персонализированный текст"""
+    def _text_prompt(self, user_profile: Dict, channel: str, context: Dict) -> str:
         prompt_template = self.get_prompt_template("text_generator")
         
-        prompt = prompt_template.format(
+        return prompt_template.format(
             name=user_profile.get("name", "Клиент"),
-            interests=json.dumps(user_profile.get("interests", []), ensure_ascii=False),
+            interests=_dumps(user_profile.get("interests", [])),
             segment=user_profile.get("segment", "new"),
             channel=channel,
-            recent_views=json.dumps(context.get("recent_views", []), ensure_ascii=False),
-            purchase_history=json.dumps(context.get("purchase_history", []), ensure_ascii=False)
+            recent_views=_dumps(context.get("recent_views", [])),
+            purchase_history=_dumps(context.get("purchase_history", []))
         )
-        
-        result = self._call_llm(prompt, "Ты — профессиональный копирайтер")
+    
+    async def generate_text(self, user_profile: Dict, channel: str, context: Dict) -> str:
+        """Сгенерировать персонализированный текст"""
+        prompt = self._text_prompt(user_profile, channel, context)
+        result = await self._call_llm(prompt, TEXT_SYSTEM_MESSAGE, kind="text")
         return result.get("text", result.get("content", ""))
     
-    def check_quality(self, message: str, user_context: Dict) -> Dict:
+    def generate_text_stream(self, user_profile: Dict, channel: str, context: Dict) -> AsyncIterator[str]:
+        """Сгенерировать персонализированный текст, отдавая его по частям"""
+        prompt = self._text_prompt(user_profile, channel, context)
+        return self._stream_llm(prompt, TEXT_SYSTEM_MESSAGE, kind="text")
+    
+    async def check_quality(self, message: str, user_context: Dict) -> Dict:
         """Проверить качество сообщения"""
-        prompt_template = self.get_prompt_template("quality_checker")
+        system = self._static_prompt("quality_checker", QUALITY_SYSTEM_MESSAGE, QUALITY_FIELDS)
         
-        if not prompt_template:
+        if not system:
             # Дефолтная проверка
             return {
                 "overall_score": 0.9,
@@ -106,19 +393,27 @@ Email: до 150 слов. Push: до 80 символов."""
                 "suggested_improvement": ""
             }
         
-        prompt = prompt_template.format(
-            message=message,
-            user_context=json.dumps(user_context, ensure_ascii=False)
-        )
-        
-        return self._call_llm(prompt, "Ты — строгий редактор")
+        prompt = _dumps_stable({"message": message, "user_context": user_context})
+        try:
+            return await self._call_llm(prompt, system, kind="quality",
+                                        semantic_key=user_context.get("user_id"),
+                                        cache_prefix=True, raise_on_error=True)
+        except LLMError:
+            # Без проверки сообщение не одобряем
+            return {
+                "overall_score": 0.0,
+                "criteria_scores": {},
+                "approved": False,
+                "comments": "LLM API недоступен",
+                "suggested_improvement": ""
+            }
     
-    def analyze_growth_opportunities(self, user_profile: Dict) -> List[Dict]:
+    async def analyze_growth_opportunities(self, user_profile: Dict) -> List[Dict]:
         """Найти точки роста для клиента"""
         prompt = f"""Ты — аналитик по увеличению LTV.
 
 Данные клиента:
-{json.dumps(user_profile, ensure_ascii=False)}
+{_dumps(user_profile)}
 
 Найди 3 точки роста. Ответь JSON:
 {{
@@ -133,61 +428,188 @@ Email: до 150 слов. Push: до 80 символов."""
   "priority_order": ["type1", "type2", "type3"]
 }}"""
         
-        result = self._call_llm(prompt, "Ты — аналитик по LTV")
+        result = await self._call_llm(prompt, "Ты — аналитик по LTV")
         return result.get("growth_opportunities", [])
     
-    def _call_llm(self, prompt: str, system_message: str = "Ты — AI-агент") -> Dict:
-        """Вызвать OpenRouter API"""
+    def _payload(self, prompt: str, system_message: str, cache_prefix: bool = False) -> Dict:
+        if cache_prefix:
+            system_content = [{
+                "type": "text",
+                "text": system_message,
+                "cache_control": {"type": "ephemeral"}
+            }]
+        else:
+            system_content = system_message
+        
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_content},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": self.temperature
+        }
+    
+    async def _stream_llm(self, prompt: str, system_message: str,
+                          kind: str = "default") -> AsyncIterator[str]:
+        """Вызвать OpenRouter API в режиме stream и отдавать текст по мере генерации
+        
+        При ошибке API или обрыве потока бросает LLMError — уже отданный
+        текст неполон, и вызывающий код должен сообщить об ошибке.
+        """
         if not self.api_key:
             print("[WARNING] OpenRouter API key not set, using mock response")
-            return self._mock_response(prompt)
+            yield self._mock_response(kind, prompt).get("text", "")
+            return
         
+        payload = self._payload(prompt, system_message)
+        payload["stream"] = True
         try:
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "https://github.com/aryazansev/AI-agent",
-                "X-Title": "AI Agent Personalization"
-            }
-            
-            payload = {
-                "model": self.model,
-                "messages": [
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": self.temperature
-            }
+            async with self._client.stream(
+                "POST",
+                f"{self.api_base}/chat/completions",
+                headers=self._headers(),
+                content=orjson.dumps(payload)
+            ) as response:
+                if response.status_code != 200:
+                    body = await response.aread()
+                    print(f"[ERROR] LLM API error: {response.status_code} - {body.decode(errors='replace')}")
+                    raise LLMError(f"LLM API error: {response.status_code}")
+                
+                async for line in response.aiter_lines():
+                    # Строки без "data: " — комментарии SSE (keep-alive)
+                    if not line.startswith("data: "):
+                        continue
+                    data = line[len("data: "):]
+                    if data == "[DONE]":
+                        break
+                    chunk = orjson.loads(data)
+                    if chunk.get("usage"):
+                        self._record_usage(chunk["usage"])
+                    choices = chunk.get("choices") or [{}]
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        yield delta
+        except LLMError:
+            self.stats["llm_failures"] += 1
+            raise
+        except Exception as e:
+            self.stats["llm_failures"] += 1
+            print(f"[ERROR] LLM stream failed: {e}")
+            raise LLMError(f"LLM stream failed: {e}") from e
+    
+    async def _call_llm(self, prompt: str, system_message: str = "Ты — AI-агент",
+                        kind: str = "default", semantic_key: Optional[str] = None,
+                        cache_prefix: bool = False, raise_on_error: bool = False) -> Dict:
+        """Вызвать OpenRouter API
+        
+        kind — тип запроса (decision/text/quality), определяет мок-ответ без API.
+        semantic_key (user_id) включает поиск по близким запросам этого же
+        пользователя — только для ответов, где разнообразие не нужно
+        (решения, проверка качества).
+        cache_prefix помечает системное сообщение для prompt caching провайдера.
+        raise_on_error: при ошибке API бросать LLMError вместо мок-ответа.
+        """
+        if not self.api_key:
+            print("[WARNING] OpenRouter API key not set, using mock response")
+            return self._mock_response(kind, prompt)
+        
+        cache_key = self._cache_key(prompt, system_message)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        
+        vector = None
+        if semantic_key and self.semantic_cache_enabled:
+            scope = self._semantic_scope(system_message, str(semantic_key))
+            vector = await self._embed(prompt)
+            if vector is not None:
+                cached = await self._semantic_get(scope, vector)
+                if cached is not None:
+                    self._cache_set(cache_key, cached)
+                    return cached
+        
+        try:
+            payload = self._payload(prompt, system_message, cache_prefix)
             
-            response = httpx.post(
+            response = await self._post_with_retry(
                 f"{self.api_base}/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=60.0
+                orjson.dumps(payload)
             )
             
             if response.status_code == 200:
-                data = response.json()
+                data = orjson.loads(response.content)
                 content = data["choices"][0]["message"]["content"]
+                self._record_usage(data.get("usage") or {})
                 
                 # Пытаемся распарсить JSON
-                try:
-                    return json.loads(content)
-                except json.JSONDecodeError:
+                result = _parse_llm_json(content)
+                if result is None:
                     # Если не JSON, возвращаем как текст
-                    return {"text": content, "raw": content}
+                    result = {"text": content, "raw": content}
+                
+                self._cache_set(cache_key, result)
+                if vector is not None:
+                    self._semantic_set(scope, vector, result)
+                return result
             else:
+                self.stats["llm_failures"] += 1
                 print(f"[ERROR] LLM API error: {response.status_code} - {response.text}")
-                return self._mock_response(prompt)
+                if raise_on_error:
+                    raise LLMError(f"LLM API error: {response.status_code}")
+                return self._mock_response(kind, prompt)
                 
+        except LLMError:
+            raise
         except Exception as e:
+            self.stats["llm_failures"] += 1
             print(f"[ERROR] LLM call failed: {e}")
-            return self._mock_response(prompt)
+            if raise_on_error:
+                raise LLMError(str(e)) from e
+            return self._mock_response(kind, prompt)
+    
+    async def _post_with_retry(self, url: str, content: bytes) -> httpx.Response:
+        """POST с повторами при 429/5xx и сетевых таймаутах
+        
+        Пауза растёт экспоненциально со случайным джиттером; для 429
+        учитывается заголовок Retry-After. Последний ответ (или исключение)
+        возвращается вызывающему коду как есть.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            retry_after = None
+            try:
+                response = await self._client.post(url, headers=self._headers(), content=content)
+            except (httpx.TimeoutException, httpx.NetworkError) as e:
+                if attempt == self.max_attempts:
+                    raise
+                print(f"[WARNING] LLM request failed ({e!r}), retrying")
+            else:
+                if response.status_code != 429 and response.status_code < 500:
+                    return response
+                if response.status_code == 429:
+                    self.stats["llm_rate_limited"] += 1
+                    retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+                if attempt == self.max_attempts:
+                    return response
+                print(f"[WARNING] LLM API returned {response.status_code}, retrying")
+            
+            self.stats["llm_retries"] += 1
+            delay = min(self.retry_max_delay, self.retry_initial_delay * 2 ** (attempt - 1))
+            delay += random.uniform(0, self.retry_initial_delay)
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self.retry_max_delay))
+            await asyncio.sleep(delay)
+    
+    def _record_usage(self, usage: Dict):
+        """Учесть токены, прочитанные из prompt cache провайдера"""
+        details = usage.get("prompt_tokens_details") or {}
+        cached = details.get("cached_tokens") or usage.get("cache_read_input_tokens") or 0
+        self.stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        self.stats["cached_prompt_tokens"] += cached
     
-    def _mock_response(self, prompt: str) -> Dict:
+    def _mock_response(self, kind: str, prompt: str = "") -> Dict:
         """Мок-ответ для тестирования без API"""
-        # Определяем тип запроса по содержимому
-        if "решение" in prompt.lower() or "should_engage" in prompt:
+        if kind == "decision":
             return {
                 "should_engage": True,
                 "reasoning": "Пользователь добавил товар в корзину, но не завершил покупку. Это хороший момент для напоминания.",
@@ -198,11 +620,11 @@ Email: до 150 слов. Push: до 80 символов."""
                     "recommendations": []
                 }
             }
-        elif "текст" in prompt.lower() or "напиши" in prompt.lower():
+        elif kind == "text":
             return {
                 "text": "Здравствуйте! У нас есть специальное предложение для вас. Проверьте свою корзину!"
             }
-        elif "проверь" in prompt.lower() or "quality" in prompt.lower():
+        elif kind == "quality":
             return {
                 "overall_score": 0.85,
                 "criteria_scores": {
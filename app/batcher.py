@@ -0,0 +1,91 @@
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional, Set
+
+
+class LLMBatcher:
+    """Микро-батчер: собирает одновременные запросы в пакеты
+
+    Запросы копятся до max_batch_size штук или max_wait секунд (что наступит
+    раньше), после чего пакет целиком передаётся в handler. Число пакетов,
+    обрабатываемых одновременно, ограничено семафором.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[List[Any]], Awaitable[List[Any]]],
+        max_batch_size: int = 16,
+        max_wait: float = 0.015,
+        max_concurrency: int = 10
+    ):
+        self._handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrency = max_concurrency
+        self._queue: Optional[asyncio.Queue] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, item: Any) -> Any:
+        """Поставить запрос в очередь и дождаться его результата"""
+        if self._worker is None or self._worker.done():
+            # Очередь и воркер создаются лениво внутри работающего event loop
+            self._queue = asyncio.Queue()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def aclose(self):
+        """Остановить воркер и дождаться уже отправленных пакетов"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self._dispatch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, batch: List[tuple]):
+        async with self._semaphore:
+            try:
+                results = await self._handler([item for item, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(
+                        f"Batch handler returned {len(results)} results for {len(batch)} items"
+                    )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
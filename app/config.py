@@ -1,5 +1,5 @@
 import os
-from pydantic_settings import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from functools import lru_cache
 
 class Settings(BaseSettings):
@@ -26,13 +26,14 @@ class Settings(BaseSettings):
     AGENT_TEMPERATURE: float = float(os.getenv("AGENT_TEMPERATURE", "0.7"))
     MAX_MESSAGES_PER_HOUR: int = int(os.getenv("MAX_MESSAGES_PER_HOUR", "1"))
     VIP_THRESHOLD: float = float(os.getenv("VIP_THRESHOLD", "10000"))
+    # Типы событий, для которых вызывается агент (через запятую, пусто — все)
+    AGENT_EVENT_TYPES: str = os.getenv("AGENT_EVENT_TYPES", "")
     
     # Server
     HOST: str = os.getenv("HOST", "0.0.0.0")
     PORT: int = int(os.getenv("PORT", "8000"))
     
-    class Config:
-        env_file = ".env"
+    model_config = SettingsConfigDict(env_file=".env")
 
 @lru_cache()
 def get_settings():
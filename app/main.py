@@ -1,24 +1,31 @@
 from fastapi import FastAPI, HTTPException, Depends, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 from typing import Optional, List, Dict
-from datetime import datetime, timedelta
-import json
+from datetime import datetime, timedelta, timezone
+import asyncio
+import orjson
 import os
+import time
+import hashlib
 import sqlite3
 from contextlib import contextmanager
 import httpx
-from jose import JWTError, jwt
+import jwt
 from passlib.context import CryptContext
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
-from app.models import init_db, get_db
-from app.agent import PersonalizationAgent
+from app.models import init_db, get_db, close_db, connect
+from app.agent import PersonalizationAgent, LLMError
 from app.config import settings
 
-app = FastAPI(title="AI Agent Personalization", version="1.0.0")
+app = FastAPI(
+    title="AI Agent Personalization",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
 
 # Security
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -30,6 +37,14 @@ app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
 # Initialize agent
 agent = PersonalizationAgent()
+# Сколько последних событий хранится в профиле пользователя
+RECENT_ACTIVITY_SIZE = 10
+# Фоновая запись событий: размер очереди и максимум строк в одной транзакции
+WRITE_QUEUE_SIZE = 10_000
+WRITE_BATCH_SIZE = 100
+# Максимум событий в одном запросе /api/events/bulk
+BULK_EVENTS_MAX = 1000
+AGENT_EVENT_TYPES = {t.strip() for t in settings.AGENT_EVENT_TYPES.split(",") if t.strip()}
 
 class Event(BaseModel):
     user_id: str
@@ -52,6 +67,10 @@ class MessageRequest(BaseModel):
     subject: Optional[str] = None
     content: str
 
+class TextRequest(BaseModel):
+    user_id: str
+    channel: str = "email"
+
 class AdminLogin(BaseModel):
     username: str
     password: str
@@ -61,6 +80,10 @@ class PromptTemplate(BaseModel):
     template: str
     description: str
 
+def rows_response(rows) -> ORJSONResponse:
+    """Отдать строки SQLite как JSON без промежуточного jsonable_encoder FastAPI"""
+    return ORJSONResponse([dict(r) for r in rows])
+
 # JWT Token functions
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -72,71 +95,179 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm="HS256")
     return encoded_jwt
 
+# Кэш успешно проверенных токенов: хэш токена -> (истекает в, username)
+_token_cache: Dict[bytes, tuple] = {}
+TOKEN_CACHE_TTL = 30
+TOKEN_CACHE_MAXSIZE = 1024
+
 async def get_current_admin(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
+    token_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    now = time.time()
+    cached = _token_cache.get(token_key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
         username: str = payload.get("sub")
         if username is None:
             raise HTTPException(status_code=401, detail="Invalid authentication")
-        return username
-    except JWTError:
+    except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication")
+    
+    if len(_token_cache) >= TOKEN_CACHE_MAXSIZE:
+        _token_cache.clear()
+    # Запись не должна пережить сам токен
+    _token_cache[token_key] = (min(now + TOKEN_CACHE_TTL, payload.get("exp", now)), username)
+    return username
+
+# Event persistence
+def as_utc(value: datetime) -> datetime:
+    """Привести время к UTC (время без зоны считается UTC)"""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def activity_entry(event: Event) -> Dict:
+    """Запись о событии для recent_activity в профиле пользователя"""
+    return {
+        "event_type": event.event,
+        "product_id": event.product_id,
+        "timestamp": as_utc(event.timestamp).isoformat(),
+        "properties": event.properties
+    }
+
+def event_row(event: Event) -> tuple:
+    return (event.user_id, event.event, event.product_id, event.timestamp,
+            orjson.dumps(event.properties).decode())
+
+def write_events(db: sqlite3.Connection, items: List[tuple]):
+    """Записать пакет событий без commit
+    
+    items — кортежи (event_row, activity_entry, message_row); для записи
+    только сообщения event_row и activity_entry равны None. Отсутствующие
+    пользователи создаются, recent_activity дополняется в порядке событий.
+    """
+    event_items = [(event_row, entry) for event_row, entry, _ in items if event_row]
+    db.executemany(
+        """INSERT INTO events (user_id, event_type, product_id, timestamp, properties)
+           VALUES (?, ?, ?, ?, ?)""",
+        [event_row for event_row, _ in event_items]
+    )
+    
+    for event_row, entry in event_items:
+        user_id = event_row[0]
+        db.execute(
+            """INSERT OR IGNORE INTO users (user_id, name, segment, total_spent, created_at)
+               VALUES (?, ?, ?, ?, ?)""",
+            (user_id, f"User_{user_id}", "new", 0, datetime.now())
+        )
+        stored = db.execute(
+            "SELECT recent_activity FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()["recent_activity"]
+        activity = [entry] + (orjson.loads(stored) if stored else [])
+        db.execute(
+            "UPDATE users SET recent_activity = ? WHERE user_id = ?",
+            (orjson.dumps(activity[:RECENT_ACTIVITY_SIZE]).decode(), user_id)
+        )
+    
+    message_rows = [message_row for _, _, message_row in items if message_row]
+    if message_rows:
+        db.executemany(
+            """INSERT INTO messages (user_id, message_type, subject, content, status, created_at)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            message_rows
+        )
+
+async def writer_loop(queue: asyncio.Queue, conn: sqlite3.Connection):
+    """Фоновая запись событий из очереди пакетами до WRITE_BATCH_SIZE строк
+    
+    Запись идёт в отдельном потоке через собственное соединение conn,
+    чтобы SQLite не блокировал event loop.
+    """
+    while True:
+        items = [await queue.get()]
+        while len(items) < WRITE_BATCH_SIZE and not queue.empty():
+            items.append(queue.get_nowait())
+        try:
+            await asyncio.to_thread(flush_events, conn, items)
+        finally:
+            for _ in items:
+                queue.task_done()
+
+def flush_events(conn: sqlite3.Connection, items: List[tuple]):
+    try:
+        write_events(conn, items)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"[ERROR] Failed to write batch of {len(items)} events: {e}")
+        if len(items) == 1:
+            return
+        # Пишем по одному, чтобы одна плохая строка не потянула за собой весь пакет
+        for item in items:
+            flush_events(conn, [item])
 
 # API Endpoints
 @app.post("/api/event")
 async def handle_event(event: Event):
     """Обработка события от пользователя"""
     with get_db() as db:
-        # Сохраняем событие
-        db.execute(
-            """INSERT INTO events (user_id, event_type, product_id, timestamp, properties)
-               VALUES (?, ?, ?, ?, ?)""",
-            (event.user_id, event.event, event.product_id, event.timestamp, json.dumps(event.properties))
-        )
-        db.commit()
-        
         # Получаем профиль пользователя
         cursor = db.execute("SELECT * FROM users WHERE user_id = ?", (event.user_id,))
         user_row = cursor.fetchone()
         
         if not user_row:
-            # Создаем нового пользователя
-            db.execute(
-                "INSERT INTO users (user_id, name, segment, total_spent, created_at) VALUES (?, ?, ?, ?, ?)",
-                (event.user_id, f"User_{event.user_id}", "new", 0, datetime.now())
-            )
-            db.commit()
             user_profile = {"user_id": event.user_id, "name": f"User_{event.user_id}", "segment": "new", "total_spent": 0}
+            stored_activity = None
         else:
             user_profile = dict(user_row)
+            stored_activity = user_profile.pop("recent_activity", None)
         
-        # Получаем недавнюю активность
-        recent_events = db.execute(
-            """SELECT * FROM events 
-               WHERE user_id = ? AND timestamp > datetime('now', '-24 hours')
-               ORDER BY timestamp DESC LIMIT 10""",
-            (event.user_id,)
-        ).fetchall()
+        # Последние события хранятся прямо в профиле, новое — первым.
+        # Событие ставится в очередь на запись до вызова агента, чтобы
+        # не потерять его, если обработка упадёт
+        entry = activity_entry(event)
+        activity = [entry] + (orjson.loads(stored_activity) if stored_activity else [])
+        await app.state.write_queue.put((event_row(event), entry, None))
         
-        recent_activity = [dict(e) for e in recent_events]
+        # Агент не вызывается для событий, которые не могут привести к сообщению
+        if AGENT_EVENT_TYPES and event.event not in AGENT_EVENT_TYPES:
+            return {"status": "skipped"}
+        
+        # Лимит сообщений в час: решение заранее известно, LLM не нужен
+        if (user_profile.get("total_spent") or 0) < settings.VIP_THRESHOLD:
+            sent_last_hour = db.execute(
+                "SELECT COUNT(*) AS count FROM messages WHERE user_id = ? AND created_at > ?",
+                (event.user_id, datetime.now() - timedelta(hours=1))
+            ).fetchone()["count"]
+            if sent_last_hour >= settings.MAX_MESSAGES_PER_HOUR:
+                return {"status": "throttled"}
+        
+        # Недавняя активность — события из профиля за последние 24 часа
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=24)
+        recent_activity = [
+            e for e in activity[:RECENT_ACTIVITY_SIZE]
+            if as_utc(datetime.fromisoformat(e["timestamp"])) > cutoff
+        ]
         
         # Вызываем агента
-        result = agent.make_decision(user_profile, event.dict(), recent_activity)
+        result = await agent.make_decision(user_profile, event.model_dump(mode="json"), recent_activity)
+        
+        # Если нужно отправить сообщение — сохраняем его
+        action = result.get("action") or {}
+        if result.get("should_engage") and action.get("type"):
+            # Запись в БД выполняет фоновый воркер, ответ не ждёт диска
+            await app.state.write_queue.put((None, None, (
+                event.user_id, action["type"], action.get("subject", ""), action.get("body", ""),
+                "pending", datetime.now()
+            )))
+        else:
+            action = None
         
-        # Если нужно отправить сообщение
-        if result.get("should_engage") and result.get("action", {}).get("type"):
-            action = result["action"]
-            # Сохраняем сообщение в базу
-            db.execute(
-                """INSERT INTO messages (user_id, message_type, subject, content, status, created_at)
-                   VALUES (?, ?, ?, ?, ?, ?)""",
-                (event.user_id, action["type"], action.get("subject", ""), action.get("body", ""), 
-                 "pending", datetime.now())
-            )
-            db.commit()
-            
-            # Отправляем сообщение
+        # Отправляем сообщение
+        if action is not None:
             if action["type"] == "email":
                 await send_email(event.user_id, action.get("subject", ""), action.get("body", ""))
             elif action["type"] == "push":
@@ -144,6 +275,16 @@ async def handle_event(event: Event):
         
         return {"status": "processed", "agent_decision": result}
 
+@app.post("/api/events/bulk")
+async def handle_events_bulk(events: List[Event]):
+    """Загрузка пакета событий (без вызова агента)"""
+    if len(events) > BULK_EVENTS_MAX:
+        raise HTTPException(status_code=413, detail=f"Too many events, max {BULK_EVENTS_MAX}")
+    # Через общую очередь, чтобы порядок recent_activity совпадал с порядком прихода
+    for e in events:
+        await app.state.write_queue.put((event_row(e), activity_entry(e), None))
+    return {"status": "queued", "count": len(events)}
+
 @app.get("/api/users/{user_id}")
 async def get_user(user_id: str, admin: str = Depends(get_current_admin)):
     """Получить профиль пользователя"""
@@ -163,7 +304,7 @@ async def get_user_events(user_id: str, admin: str = Depends(get_current_admin))
             (user_id,)
         )
         events = cursor.fetchall()
-        return [dict(e) for e in events]
+        return rows_response(events)
 
 @app.get("/api/users/{user_id}/messages")
 async def get_user_messages(user_id: str, admin: str = Depends(get_current_admin)):
@@ -174,7 +315,7 @@ async def get_user_messages(user_id: str, admin: str = Depends(get_current_admin
             (user_id,)
         )
         messages = cursor.fetchall()
-        return [dict(m) for m in messages]
+        return rows_response(messages)
 
 @app.post("/api/admin/login")
 async def admin_login(login: AdminLogin):
@@ -189,12 +330,12 @@ async def admin_login(login: AdminLogin):
 async def admin_dashboard(admin: str = Depends(get_current_admin)):
     """Статистика для дашборда"""
     with get_db() as db:
-        total_users = db.execute("SELECT COUNT(*) as count FROM users").fetchone()["count"]
-        total_events = db.execute("SELECT COUNT(*) as count FROM events").fetchone()["count"]
-        total_messages = db.execute("SELECT COUNT(*) as count FROM messages").fetchone()["count"]
-        pending_messages = db.execute(
-            "SELECT COUNT(*) as count FROM messages WHERE status = 'pending'"
-        ).fetchone()["count"]
+        counts = db.execute(
+            """SELECT (SELECT COUNT(*) FROM users) AS total_users,
+                      (SELECT COUNT(*) FROM events) AS total_events,
+                      (SELECT COUNT(*) FROM messages) AS total_messages,
+                      (SELECT COUNT(*) FROM messages WHERE status = 'pending') AS pending_messages"""
+        ).fetchone()
         
         recent_events = db.execute(
             """SELECT * FROM events 
@@ -203,11 +344,12 @@ async def admin_dashboard(admin: str = Depends(get_current_admin)):
         ).fetchall()
         
         return {
-            "total_users": total_users,
-            "total_events": total_events,
-            "total_messages": total_messages,
-            "pending_messages": pending_messages,
-            "recent_events": [dict(e) for e in recent_events]
+            "total_users": counts["total_users"],
+            "total_events": counts["total_events"],
+            "total_messages": counts["total_messages"],
+            "pending_messages": counts["pending_messages"],
+            "recent_events": [dict(e) for e in recent_events],
+            "llm_stats": agent.stats
         }
 
 @app.get("/api/admin/prompts")
@@ -216,7 +358,7 @@ async def get_prompts(admin: str = Depends(get_current_admin)):
     with get_db() as db:
         cursor = db.execute("SELECT * FROM prompts ORDER BY created_at DESC")
         prompts = cursor.fetchall()
-        return [dict(p) for p in prompts]
+        return rows_response(prompts)
 
 @app.post("/api/admin/prompts")
 async def create_prompt(prompt: PromptTemplate, admin: str = Depends(get_current_admin)):
@@ -228,6 +370,7 @@ async def create_prompt(prompt: PromptTemplate, admin: str = Depends(get_current
             (prompt.name, prompt.template, prompt.description, datetime.now(), datetime.now())
         )
         db.commit()
+        agent.invalidate_prompts()
         return {"status": "created"}
 
 @app.put("/api/admin/prompts/{prompt_id}")
@@ -240,8 +383,46 @@ async def update_prompt(prompt_id: int, prompt: PromptTemplate, admin: str = Dep
             (prompt.name, prompt.template, prompt.description, datetime.now(), prompt_id)
         )
         db.commit()
+        # Промпт мог быть переименован, поэтому сбрасываем кэш целиком
+        agent.invalidate_prompts()
         return {"status": "updated"}
 
+@app.post("/api/admin/generate-text")
+async def generate_text(request: TextRequest, admin: str = Depends(get_current_admin)):
+    """Сгенерировать текст сообщения для пользователя (Server-Sent Events)"""
+    with get_db() as db:
+        user = db.execute("SELECT * FROM users WHERE user_id = ?", (request.user_id,)).fetchone()
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        recent_views = db.execute(
+            """SELECT product_id FROM events
+               WHERE user_id = ? AND product_id IS NOT NULL
+               ORDER BY timestamp DESC LIMIT 10""",
+            (request.user_id,)
+        ).fetchall()
+    
+    user_profile = dict(user)
+    user_profile["interests"] = orjson.loads(user["interests"]) if user["interests"] else []
+    context = {"recent_views": [row["product_id"] for row in recent_views]}
+    
+    async def event_stream():
+        try:
+            async for delta in agent.generate_text_stream(user_profile, request.channel, context):
+                yield b"data: " + orjson.dumps({"text": delta}) + b"\n\n"
+        except LLMError as e:
+            # Текст оборван — явная ошибка вместо [DONE]
+            yield b"event: error\ndata: " + orjson.dumps({"error": str(e)}) + b"\n\n"
+            return
+        yield b"data: [DONE]\n\n"
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.post("/api/admin/cache/clear")
+async def clear_cache(admin: str = Depends(get_current_admin)):
+    """Очистить кэш ответов LLM"""
+    agent.cache_clear()
+    return {"status": "cleared"}
+
 @app.get("/api/admin/messages")
 async def get_all_messages(admin: str = Depends(get_current_admin)):
     """Получить все сообщения"""
@@ -250,7 +431,7 @@ async def get_all_messages(admin: str = Depends(get_current_admin)):
             "SELECT * FROM messages ORDER BY created_at DESC LIMIT 100"
         )
         messages = cursor.fetchall()
-        return [dict(m) for m in messages]
+        return rows_response(messages)
 
 # Web Interface
 @app.get("/", response_class=HTMLResponse)
@@ -300,6 +481,24 @@ async def send_push(user_id: str, message: str):
 async def startup_event():
     init_db()
     print("Database initialized")
+    app.state.write_queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+    app.state.writer_conn = connect()
+    app.state.writer_task = asyncio.create_task(
+        writer_loop(app.state.write_queue, app.state.writer_conn)
+    )
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await agent.aclose()
+    # Дописываем всё, что осталось в очереди, до закрытия базы
+    await app.state.write_queue.join()
+    app.state.writer_task.cancel()
+    try:
+        await app.state.writer_task
+    except asyncio.CancelledError:
+        pass
+    app.state.writer_conn.close()
+    close_db()
 
 if __name__ == "__main__":
     import uvicorn
@@ -2,7 +2,7 @@ import sqlite3
 from contextlib import contextmanager
 from datetime import datetime
 import os
-import json
+from typing import Optional
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./data/app.db")
 
@@ -12,19 +12,49 @@ def get_db_path():
         return DATABASE_URL.replace("sqlite:///", "")
     return "./data/app.db"
 
-@contextmanager
-def get_db():
-    """Контекстный менеджер для работы с базой данных"""
+def connect() -> sqlite3.Connection:
+    """Открыть новое соединение с базой данных"""
     db_path = get_db_path()
     # Создаем директорию если нужно
     os.makedirs(os.path.dirname(db_path), exist_ok=True)
     
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(db_path, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    # WAL: читатели не блокируются писателем, fsync только на checkpoint
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    # Ждём, а не падаем, если другое соединение сейчас пишет
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+# Одно соединение на процесс: открывается при первом обращении и переиспользуется
+_connection: Optional[sqlite3.Connection] = None
+
+def _get_connection() -> sqlite3.Connection:
+    global _connection
+    if _connection is None:
+        _connection = connect()
+    return _connection
+
+@contextmanager
+def get_db():
+    """Контекстный менеджер для работы с базой данных"""
+    conn = _get_connection()
     try:
         yield conn
-    finally:
-        conn.close()
+    except Exception:
+        # Не оставляем незавершённую транзакцию на общем соединении
+        conn.rollback()
+        raise
+
+def close_db():
+    """Закрыть соединение с базой данных"""
+    global _connection
+    if _connection is not None:
+        _connection.close()
+        _connection = None
 
 def init_db():
     """Инициализация базы данных"""
@@ -43,11 +73,17 @@ def init_db():
                 segment TEXT DEFAULT 'new',
                 total_spent REAL DEFAULT 0,
                 interests TEXT, -- JSON array
+                recent_activity TEXT, -- JSON array последних событий, новые первыми
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
         
+        # Миграция: колонка recent_activity появилась позже
+        user_columns = {row["name"] for row in db.execute("PRAGMA table_info(users)")}
+        if "recent_activity" not in user_columns:
+            db.execute("ALTER TABLE users ADD COLUMN recent_activity TEXT")
+        
         # Таблица событий
         db.execute("""
             CREATE TABLE IF NOT EXISTS events (
@@ -102,8 +138,10 @@ def init_db():
         # Индексы
         db.execute("CREATE INDEX IF NOT EXISTS idx_events_user_id ON events(user_id)")
         db.execute("CREATE INDEX IF NOT EXISTS idx_events_timestamp ON events(timestamp)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_events_user_ts ON events(user_id, timestamp DESC)")
         db.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id)")
         db.execute("CREATE INDEX IF NOT EXISTS idx_messages_status ON messages(status)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_created ON messages(user_id, created_at DESC)")
         
         # Добавляем дефолтные промпты если их нет
         default_prompts = [